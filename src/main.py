@@ -1,17 +1,29 @@
 """GoManage API Gateway (optimizado y corregido)"""
 from __future__ import annotations
 
-import json
+import bisect
 import logging
+import math
 import os
-from datetime import datetime, timedelta
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
+import orjson
 import requests
 from dotenv import load_dotenv
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, make_response, render_template, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, model_validator
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------------------------------------------------------------------------
 # CONFIGURACIÓN
@@ -24,11 +36,29 @@ class Config:
     PASSWORD: str = os.getenv("GOMANAGE_PASSWORD")
     AUTH_TOKEN: str = os.getenv("GOMANAGE_AUTH_TOKEN", "")
     CACHE_TTL: int = 7200  # segundos
+    CONNECT_TIMEOUT: int = 10  # segundos
+    READ_TIMEOUT: int = 25  # segundos
+    PAGE_SIZE: int = 500
+    PAGE_WORKERS: int = 8  # debe ser <= pool_maxsize de la sesión HTTP
 
 # ---------------------------------------------------------------------------
 # APP + LOG
 # ---------------------------------------------------------------------------
+class ORJSONProvider(DefaultJSONProvider):
+    """Serializa las respuestas con orjson (mucho más rápido que json estándar)."""
+
+    # Igual que DefaultJSONProvider (sort_keys=True): claves ordenadas.
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=self._OPTIONS).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)-8s | %(message)s")
@@ -38,30 +68,57 @@ logger = logging.getLogger("gomanage-api")
 # SESIÓN Y CACHÉ
 # ---------------------------------------------------------------------------
 _session_id: Optional[str] = None
-_session_expires: Optional[datetime] = None
-_customers_cache: List[Dict[str, Any]] = []
+_session_expires: Optional[datetime] = None  # solo para logs
+_session_expires_mono: float = 0.0  # reloj monotónico, usado para validar
+_auth_lock = threading.Lock()
+_customers_lock = threading.Lock()  # serializa cargas y altas; los lectores no lo usan
+_customers: Optional[CustomerCache] = None  # snapshot publicado; None = sin cargar
+SEARCH_FIELDS = ("name", "business_name", "vat_number", "province_name", "city", "email")
+
+# Sesión HTTP compartida: keep-alive + pool de conexiones hacia GoManage.
+# El cookie jar guarda el JSESSIONID tras el login. Authorization/Accept solo
+# van en las llamadas de `_request`, no en el login.
+_http = requests.Session()
+_http.headers["Accept-Encoding"] = "gzip, deflate"
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    # raise_on_status=False: agotados los reintentos se devuelve la última
+    # respuesta y la trata raise_for_status() (HTTPError, no RetryError).
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                      raise_on_status=False),
+)
+_http.mount("http://", _adapter)
+_http.mount("https://", _adapter)
 
 
 def _is_session_valid() -> bool:
-    return bool(_session_id and _session_expires and _session_expires > datetime.utcnow())
+    return _session_id is not None and time.monotonic() < _session_expires_mono
 
 
-def _authenticate() -> None:
-    """Login y guarda JSESSIONID."""
-    global _session_id, _session_expires
+def _authenticate(stale: Optional[str] = None) -> None:
+    """Login y guarda JSESSIONID (serializado: un solo login a la vez).
+
+    `stale` es el JSESSIONID rechazado con 401; si otro hilo ya renovó la
+    sesión mientras se esperaba el lock, no se repite el login.
+    """
+    global _session_id, _session_expires, _session_expires_mono
     url = f"{Config.BASE_URL}/gomanage/static/auth/j_spring_security_check"
     data = {"j_username": Config.USERNAME, "j_password": Config.PASSWORD}
-    resp = requests.post(url, data=data, timeout=15, allow_redirects=False)
-    resp.raise_for_status()
-    cookie = resp.headers.get("Set-Cookie", "")
-    for part in cookie.split(";"):
-        if part.strip().startswith("JSESSIONID"):
-            _session_id = part.split("=", 1)[1]
-            _session_expires = datetime.utcnow() + timedelta(seconds=Config.CACHE_TTL)
-            logger.info("Sesión GoManage establecida (expira %s)", _session_expires.isoformat())
-            break
-    else:
-        raise RuntimeError("JSESSIONID no encontrado en la cabecera Set-Cookie")
+    with _auth_lock:
+        if _is_session_valid() and _session_id != stale:
+            return
+        # Jar limpio: evita enviar un JSESSIONID caducado y que convivan dos
+        # cookies JSESSIONID (CookieConflictError en cookies.get).
+        _http.cookies.clear()
+        resp = _http.post(url, data=data, timeout=(Config.CONNECT_TIMEOUT, 15), allow_redirects=False)
+        resp.raise_for_status()
+        _session_id = _http.cookies.get("JSESSIONID")
+        if not _session_id:
+            raise RuntimeError("JSESSIONID no encontrado en la respuesta de login")
+        _session_expires_mono = time.monotonic() + Config.CACHE_TTL
+        _session_expires = datetime.now(timezone.utc) + timedelta(seconds=Config.CACHE_TTL)
+        logger.info("Sesión GoManage establecida (expira %s)", _session_expires.isoformat())
 
 
 def session_required(func):
@@ -73,77 +130,235 @@ def session_required(func):
     return wrapper
 
 
-@session_required
 def _request(method: str, endpoint: str, **kwargs) -> requests.Response:
+    """Llamada a GoManage; las rutas ya garantizan sesión con @session_required."""
     url = f"{Config.BASE_URL}{endpoint}"
     headers = {
-        "Cookie": f"JSESSIONID={_session_id}",
         "Authorization": f"oecp {Config.AUTH_TOKEN}",
         "Accept": "application/json",
     }
     if kwargs.get("json") is not None:
         headers["Content-Type"] = "application/json"
-    resp = requests.request(method, url, headers=headers, timeout=25, **kwargs)
+    timeout = (Config.CONNECT_TIMEOUT, Config.READ_TIMEOUT)
+    sent_session = _session_id
+    resp = _http.request(method, url, headers=headers, timeout=timeout, **kwargs)
     if resp.status_code == 401:
-        _authenticate()
-        headers["Cookie"] = f"JSESSIONID={_session_id}"
-        resp = requests.request(method, url, headers=headers, timeout=25, **kwargs)
+        _authenticate(stale=sent_session)
+        resp = _http.request(method, url, headers=headers, timeout=timeout, **kwargs)
     resp.raise_for_status()
     return resp
 
 
 def _load_paginated(endpoint: str) -> List[dict]:
-    page, size, out = 1, 500, []
-    while True:
-        data = _request("GET", endpoint, params={"page": page, "size": size}).json()
-        out.extend(data.get("page_entries", []))
-        if len(out) >= data.get("total_entries", 0):
-            break
-        page += 1
+    """Descarga todas las páginas: la 1ª da `total_entries`, el resto van en paralelo."""
+    size = Config.PAGE_SIZE
+    resp = _request("GET", endpoint, params={"page": 1, "size": size})
+    if resp.headers.get("Content-Encoding", "") not in ("gzip", "deflate"):
+        logger.warning("GoManage no comprime la respuesta de %s (Content-Encoding: %r)",
+                       endpoint, resp.headers.get("Content-Encoding"))
+    first = orjson.loads(resp.content)
+    out = list(first.get("page_entries", []))
+    n_pages = math.ceil(first.get("total_entries", 0) / size)
+    if n_pages <= 1:
+        return out
+    with ThreadPoolExecutor(max_workers=Config.PAGE_WORKERS) as ex:
+        futures = [
+            ex.submit(_request, "GET", endpoint, params={"page": page, "size": size})
+            for page in range(2, n_pages + 1)
+        ]
+        for fut in futures:
+            out.extend(orjson.loads(fut.result().content).get("page_entries", []))
     return out
 
 
-def _ensure_customers_loaded() -> None:
-    if not _customers_cache:
-        logger.info("Descargando clientes …")
-        _customers_cache.extend(_load_paginated("/gomanage/web/data/apitmt-customers/List"))
-        logger.info("Clientes cargados: %d", len(_customers_cache))
+def _norm(value: Any) -> str:
+    return str(value).lower().strip() if value is not None else ""
+
+
+def _customer_id(c: Dict[str, Any]) -> Any:
+    return c.get("customer_id")
+
+
+def _customer_type(c: Dict[str, Any]) -> str:
+    return c.get("tip_cli", "otros")
+
+
+def _customer_province(c: Dict[str, Any]) -> str:
+    return c.get("province_name", "Sin provincia")
+
+
+class CustomerCache:
+    """Clientes descargados junto con sus índices de búsqueda y agregados.
+
+    Se construye entera antes de publicarse en `_customers` y después no se
+    modifica: un alta crea una instancia nueva, así los lectores nunca ven
+    una caché a medio indexar.
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]]) -> None:
+        # Orden por customer_id (único) para la paginación por cursor. Si no se
+        # puede, se mantiene el orden de GoManage, `ids` queda vacío y
+        # `cursor_error` explica por qué el cursor no está disponible.
+        self.rows: List[Dict[str, Any]] = list(rows)
+        self.ids: List[Any] = []
+        self.cursor_error: Optional[str] = None
+        ids = [_customer_id(c) for c in self.rows]
+        if any(i is None for i in ids):
+            self.cursor_error = "hay clientes sin customer_id"
+        else:
+            try:
+                order = sorted(range(len(ids)), key=ids.__getitem__)
+            except TypeError:
+                self.cursor_error = "los customer_id no son comparables entre sí"
+            else:
+                sorted_ids = [ids[i] for i in order]
+                if any(a == b for a, b in zip(sorted_ids, sorted_ids[1:])):
+                    self.cursor_error = "hay customer_id duplicados"
+                else:
+                    self.rows = [self.rows[i] for i in order]
+                    self.ids = sorted_ids
+        # ETag: time_ns() en lugar de un contador para que no coincida entre
+        # workers ni tras reinicios.
+        self.version = time.time_ns()
+
+        # Blobs de búsqueda (SEARCH_FIELDS en minúsculas) contiguos en un único
+        # buffer separados por b"\x00"; `search_offsets[i]` = inicio del i-ésimo.
+        buffer = bytearray()
+        self.search_offsets: List[int] = []
+        for c in self.rows:
+            self.search_offsets.append(len(buffer))
+            buffer.extend(" ".join(_norm(c.get(k)) for k in SEARCH_FIELDS).encode())
+            buffer.append(0)
+        self.search_buffer = bytes(buffer)
+
+        self.by_type = dict(Counter(map(_customer_type, self.rows)))
+        self.top_provinces = dict(Counter(map(_customer_province, self.rows)).most_common(10))
+
+    def search(self, search: str) -> List[int]:
+        """Posiciones de `rows` cuyos SEARCH_FIELDS contienen `search` (ya en minúsculas).
+
+        Búsqueda de subcadena sobre el buffer contiguo: un `find` por coincidencia.
+        """
+        needle = search.encode()
+        if b"\x00" in needle:
+            return []
+        hits: List[int] = []
+        pos = self.search_buffer.find(needle)
+        while pos >= 0:
+            row = bisect.bisect_right(self.search_offsets, pos) - 1
+            hits.append(row)
+            if row + 1 >= len(self.search_offsets):
+                break
+            pos = self.search_buffer.find(needle, self.search_offsets[row + 1])
+        return hits
+
+
+def _ensure_customers_loaded() -> CustomerCache:
+    global _customers
+    cache = _customers
+    if cache is not None:
+        return cache
+    with _customers_lock:
+        if _customers is None:
+            logger.info("Descargando clientes …")
+            _customers = CustomerCache(_load_paginated("/gomanage/web/data/apitmt-customers/List"))
+            logger.info("Clientes cargados: %d", len(_customers.rows))
+        return _customers
 
 # ---------------------------------------------------------------------------
 # RUTAS
 # ---------------------------------------------------------------------------
+# -- Helpers -----------------------------------------------------------------
+def _conditional(etag: str, view: Callable[[], Any]) -> Response:
+    """GET condicional: 304 si el cliente ya tiene `etag`; si no, `view()` con ETag.
+
+    If-None-Match se compara en modo débil (RFC 9110 §13.1.2).
+    """
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = make_response(view())
+        if resp.status_code != 200:
+            return resp
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "max-age=0, must-revalidate"
+    return resp
+
+
+# La portada no recibe contexto: se renderiza una vez al arrancar.
+with app.app_context():
+    _INDEX_HTML = render_template("index_improved.html")
+
+
 @app.route("/")
 def index():
-    return render_template("index_improved.html")
+    return Response(_INDEX_HTML, mimetype="text/html", headers={"Cache-Control": "public, max-age=300"})
 
 
 @app.route("/api/auth", methods=["POST"])
 @session_required
 def auth():
-    _ensure_customers_loaded()
+    cache = _ensure_customers_loaded()
     return jsonify({
         "status": "success",
         "session_id": _session_id[:8] + "…" if _session_id else None,
-        "customers_loaded": len(_customers_cache),
+        "customers_loaded": len(cache.rows),
     })
 
 # -- Customers ---------------------------------------------------------------
+class CustomerListParams(BaseModel):
+    """Query string de GET /api/customers, acotada para no servir páginas gigantes."""
+    model_config = ConfigDict(extra="forbid")
+
+    page: int = Field(1, ge=1, le=10000)
+    per_page: int = Field(50, ge=1, le=200)
+    search: str = ""
+    after: Optional[str] = None
+
+    @model_validator(mode="after")
+    def _cursor_alone(self) -> "CustomerListParams":
+        # El cursor recorre la caché completa por customer_id; no se combina con
+        # búsqueda ni con paginación por número de página.
+        if self.after is not None:
+            if self.search.strip():
+                raise ValueError("`after` no se puede combinar con `search`")
+            if "page" in self.model_fields_set:
+                raise ValueError("`after` no se puede combinar con `page`")
+        return self
+
+
 @app.route("/api/customers", methods=["GET"])
 @session_required
 def get_customers():
-    page = int(request.args.get("page", 1))
-    per_page = int(request.args.get("per_page", 50))
-    search = request.args.get("search", "").lower().strip()
-
-    _ensure_customers_loaded()
-    rows = _customers_cache
+    try:
+        params = CustomerListParams(**request.args.to_dict())
+    except ValidationError as exc:
+        return jsonify({"error": "Parámetros no válidos",
+                        "detail": exc.errors(include_url=False, include_context=False)}), 400
+    page, per_page, after = params.page, params.per_page, params.after
+    search = params.search.lower().strip()
+
+    cache = _ensure_customers_loaded()
+    if after is not None:
+        etag = f"{cache.version}-after-{per_page}-{zlib.crc32(after.encode()):08x}"
+        return _conditional(etag, lambda: _customers_after(cache, after, per_page))
+    etag = f"{cache.version}-{page}-{per_page}-{zlib.crc32(search.encode()):08x}"
+    return _conditional(etag, lambda: _customers_page(cache, page, per_page, search))
+
+
+def _customers_page(cache: CustomerCache, page: int, per_page: int, search: str):
+    start, end = (page - 1) * per_page, page * per_page
     if search:
-        rows = [c for c in rows if search in json.dumps(c).lower()]
+        # Solo se materializan los clientes de la página pedida.
+        hits = cache.search(search)
+        total = len(hits)
+        rows = [cache.rows[i] for i in hits[start:end]]
+    else:
+        total = len(cache.rows)
+        rows = cache.rows[start:end]
 
-    total = len(rows)
-    start, end = (page - 1) * per_page, page * per_page
     return jsonify({
-        "customers": rows[start:end],
+        "customers": rows,
         "pagination": {
             "page": page,
             "per_page": per_page,
@@ -153,9 +368,42 @@ def get_customers():
     })
 
 
+def _customers_after(cache: CustomerCache, after: str, per_page: int):
+    """Paginación por cursor (keyset): clientes con customer_id > `after`, en orden ascendente."""
+    if cache.cursor_error:
+        return jsonify({"error": f"Paginación por cursor no disponible: {cache.cursor_error}"}), 400
+    try:
+        key = type(cache.ids[0])(after) if cache.ids else after
+    except ValueError:
+        return jsonify({"error": f"Cursor no válido: {after}"}), 400
+    start = bisect.bisect_right(cache.ids, key)
+    rows = cache.rows[start:start + per_page]
+    has_more = start + per_page < len(cache.rows)
+    return jsonify({
+        "customers": rows,
+        "pagination": {
+            "after": after,
+            "per_page": per_page,
+            "total": len(cache.rows),
+            "next_cursor": _customer_id(rows[-1]) if rows and has_more else None,
+        },
+    })
+
+
+def _is_new_customer(cache: CustomerCache, customer: Any) -> bool:
+    if not isinstance(customer, dict) or not cache.ids:
+        return False
+    cid = _customer_id(customer)
+    if type(cid) is not type(cache.ids[0]):
+        return False
+    i = bisect.bisect_left(cache.ids, cid)
+    return i == len(cache.ids) or cache.ids[i] != cid
+
+
 @app.route("/api/customers", methods=["POST"])
 @session_required
 def create_customer():
+    global _customers
     payload = request.get_json(silent=True) or {}
 
     required = {"business_name", "name", "vat_number"}
@@ -175,31 +423,39 @@ def create_customer():
         logger.error("GoManage 4xx/5xx -> %s", detail[:400])
         return jsonify({"status": "error", "detail": detail}), exc.response.status_code if exc.response else 502
 
-    _customers_cache.clear()
-    return jsonify({"status": "success", "customer": resp.json()})
+    customer = resp.json()
+    with _customers_lock:
+        if _customers is not None:
+            # Solo se añade el alta si la respuesta es claramente un cliente nuevo
+            # (customer_id del mismo tipo que los cargados y sin repetir); si no,
+            # se descarta la caché y se recargará al pedirla.
+            if _is_new_customer(_customers, customer):
+                _customers = CustomerCache(_customers.rows + [customer])
+            else:
+                _customers = None
+    return jsonify({"status": "success", "customer": customer})
 
 # -- Analytics ---------------------------------------------------------------
 @app.route("/api/analytics/dashboard", methods=["GET"])
 @session_required
 def analytics_dashboard():
-    _ensure_customers_loaded()
-    by_type: Dict[str, int] = {}
-    provinces: Dict[str, int] = {}
-    for c in _customers_cache:
-        by_type[c.get("tip_cli", "otros")] = by_type.get(c.get("tip_cli", "otros"), 0) + 1
-        provinces[c.get("province_name", "Sin provincia")] = provinces.get(c.get("province_name", "Sin provincia"), 0) + 1
-    top_provinces = dict(sorted(provinces.items(), key=lambda kv: kv[1], reverse=True)[:10])
-    return jsonify({"customers": {"total": len(_customers_cache), "by_type": by_type, "top_provinces": top_provinces}})
+    cache = _ensure_customers_loaded()
+    return _conditional(str(cache.version), lambda: jsonify({"customers": {
+        "total": len(cache.rows), "by_type": cache.by_type, "top_provinces": cache.top_provinces,
+    }}))
 
 # -- Chat MCP ----------------------------------------------------------------
+_CUSTOMERS_INTENT = re.compile(r"cliente", re.IGNORECASE)
+
+
 @app.route("/api/chat/mcp", methods=["POST"])
 @session_required
 def chat_mcp():
-    question = (request.get_json(silent=True) or {}).get("question", "").lower().strip()
+    question = (request.get_json(silent=True) or {}).get("question", "").strip()
     if not question:
         return jsonify({"error": "Pregunta vacía"}), 400
-    if "cliente" in question:
-        return jsonify({"response": f"Tenemos {len(_customers_cache)} clientes registrados"})
+    if _CUSTOMERS_INTENT.search(question):
+        return jsonify({"response": f"Tenemos {len(_customers.rows) if _customers else 0} clientes registrados"})
     return jsonify({"response": "No entiendo la pregunta"})
 
 # ---------------------------------------------------------------------------